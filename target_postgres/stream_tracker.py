@@ -0,0 +1,267 @@
+from array import array
+from bisect import bisect_right
+import heapq
+import json
+import queue
+import sys
+import threading
+
+import singer
+import singer.statediff as statediff
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+LOGGER = singer.get_logger()
+
+# Queued to the emit worker to tell it to exit once everything ahead of it has been processed
+_SHUTDOWN = object()
+
+
+class TargetError(Exception):
+    """
+    Raise when there is an Exception streaming data to the target.
+    """
+
+
+class _StreamSlot:
+    """
+    Per-stream bookkeeping kept deliberately small: `handle_record_message` runs once per input row, so the slot caches the
+    bound `add_record_message` method and the latest add watermark behind a single dict lookup.
+    """
+
+    __slots__ = ('buffer', 'add', 'watermark', 'added', 'flush_watermark', 'version')
+
+    def __init__(self, buffered_stream):
+        self.buffer = buffered_stream
+        self.add = buffered_stream.add_record_message
+        self.watermark = 0
+        self.added = False
+        self.flush_watermark = 0
+        self.version = 0  # bumped on each heap push so stale heap entries can be recognized
+
+
+class StreamTracker:
+    """
+    Object to track STATE messages coming in from the tap and which streams need to be flushed before they can be safely emitted.
+    Because Singer taps don't have a standard way of expressing which streams correspond to which STATEs, the target can only safely
+    emit a STATE message once all the records that came in prior to that STATE in the stream. Because target-postgres buffers
+    the records in BufferedSingerStreams, the STATE messages need to be delayed until all the records that came before them have been
+    saved to the database from their buffers.
+    """
+
+    # How many messages a queued STATE may trail the safe flush threshold by before we force a flush of all
+    # buffers just to let it out. Keeps long-running, slow-filling streams from holding back states forever.
+    # The allowance shrinks as the state queue deepens (more bookmarks to lose on a crash), but eager flushes
+    # are rate limited so a deep queue can't thrash half-empty buffers.
+    max_watermark_lag = 1000000
+    eager_flush_interval = 200000
+
+    def __init__(self, target, emit_states):
+        self.target = target
+        self.emit_states = emit_states
+        # Bound once so each batch write is a single-level call (the target can be None in state-only runs)
+        self._write_batch = target.write_batch if target is not None else None
+
+        self.streams = {}  # stream name -> _StreamSlot
+
+        # Lazily maintained min-heap over the flush watermarks so that `_safe_flush_threshold` doesn't have to rescan
+        # every stream on every STATE message. Entries are (watermark, version, stream); stale versions are skipped.
+        self._flush_watermarks_heap = []
+        self._cached_safe_threshold = None
+
+        # True whenever every buffer is known to be empty (startup, or right after a forced flush with no
+        # records since): any STATE is then safe and the threshold is just the message counter.
+        self._all_flushed = True
+
+        # Queued STATE messages kept as parallel sequences: the watermarks are nondecreasing (message_counter is
+        # monotonic) so the emittable prefix can be found with a bisect instead of popping entries one by one.
+        # Watermarks live in a packed int64 array rather than a list of boxed ints.
+        self._state_values = []
+        self._state_watermarks = array('q')
+        self.message_counter = 0
+        self._last_forced_flush_counter = 0
+        self.last_emitted_state = {}
+        self._last_emitted_state_line = None
+
+        # Emit straight to the byte layer under sys.stdout, bound once: this skips the text wrapper's lock and
+        # UTF-8 encode on every STATE line. Each line is flushed at the state boundary, never in between.
+        stdout_buffer = sys.stdout.buffer
+        self._stdout_write = stdout_buffer.write
+        self._stdout_flush = stdout_buffer.flush
+
+        # The structural diff and JSON encode of emittable states run on a worker thread so they don't stall
+        # record ingest. The bounded queue provides backpressure, and `flush_streams` joins it so every flush
+        # boundary (including the final forced flush) still guarantees the pending states have hit stdout.
+        self._emit_queue = queue.Queue(maxsize=64)
+        self._emit_worker_error = None
+        self._emit_worker = threading.Thread(target=self._run_emit_worker, daemon=True)
+        self._emit_worker.start()
+
+    def register_stream(self, stream, buffered_stream):
+        self.streams[stream] = _StreamSlot(buffered_stream)
+
+    def flush_streams(self, force=False):
+        need_force = force
+        if not need_force and self._state_watermarks \
+                and (self.message_counter - self._last_forced_flush_counter) > self.eager_flush_interval:
+            watermark_lag = self.message_counter - self._safe_flush_threshold()
+            effective_lag = self.max_watermark_lag // max(1, len(self._state_watermarks) // 16)
+            if watermark_lag > effective_lag:
+                LOGGER.info('Forcing flush of all streams: queued STATE is {} messages behind '
+                            '(allowed lag {} at queue depth {})'.format(
+                                watermark_lag, effective_lag, len(self._state_watermarks)))
+                need_force = True
+
+        for (stream, slot) in self.streams.items():
+            if need_force or slot.buffer.buffer_full:
+                self._write_batch_and_update_watermarks(stream, slot)
+
+        if need_force:
+            self._all_flushed = True
+            self._last_forced_flush_counter = self.message_counter
+
+        if self._state_watermarks:
+            self._emit_safe_queued_states(force=need_force)
+        self._drain_emit_queue()
+
+    def close(self):
+        """
+        Stop the emit worker after it has processed everything already queued. The tracker cannot emit states
+        after this; callers are expected to have run a final `flush_streams(force=True)` first.
+        """
+        if self._emit_worker.is_alive():
+            self._emit_queue.put(_SHUTDOWN)
+            self._emit_worker.join()
+
+    def _drain_emit_queue(self):
+        self._emit_queue.join()
+        if self._emit_worker_error is not None:
+            error = self._emit_worker_error
+            self._emit_worker_error = None
+            raise error
+
+    def _write_batch_and_update_watermarks(self, stream, slot):
+        self._write_batch(slot.buffer)
+        slot.buffer.flush_buffer()
+        slot.flush_watermark = slot.watermark
+        if slot.added:
+            self._push_flush_watermark(stream, slot)
+
+    def handle_state_message(self, value):
+        if not self.emit_states:
+            return
+
+        watermarks = self._state_watermarks
+        if watermarks and watermarks[-1] == self.message_counter:
+            # A burst of STATEs with no records in between all become emittable together and only the last one
+            # would be emitted anyway, so overwrite in place. The earlier state was already found unemittable at
+            # this watermark, so there's nothing new to try to emit.
+            self._state_values[-1] = value
+            return
+
+        self._state_values.append(value)
+        watermarks.append(self.message_counter)
+        self._emit_safe_queued_states()
+
+    def handle_record_message(self, stream, line_data):
+        slot = self.streams.get(stream)
+        if slot is None:
+            raise TargetError('A record for stream {} was encountered before a corresponding schema'.format(stream))
+
+        if not slot.added:
+            # Streams only participate in the safe flush threshold once they have actually received a record;
+            # a registered-but-empty stream would otherwise pin the threshold at zero forever.
+            slot.added = True
+            self._push_flush_watermark(stream, slot)
+
+        self.message_counter += 1
+        slot.watermark = self.message_counter
+        self._all_flushed = False
+        slot.add(line_data)
+
+    def _push_flush_watermark(self, stream, slot):
+        version = slot.version + 1
+        slot.version = version
+        heapq.heappush(self._flush_watermarks_heap, (slot.flush_watermark, version, stream))
+        self._cached_safe_threshold = None
+
+    def _safe_flush_threshold(self):
+        # State messages that occured before the least recently flushed record are safe to emit.
+        # If they occurred after some records that haven't yet been flushed, they aren't safe to emit.
+        # Because records arrive at different rates from different streams, we take the earliest unflushed record as the threshold for what
+        # STATE messages are safe to emit.
+        if self._all_flushed:
+            return self.message_counter
+
+        threshold = self._cached_safe_threshold
+        if threshold is not None:
+            return threshold
+
+        if len(self.streams) <= 4:
+            # With a handful of streams a plain scan beats maintaining the heap
+            threshold = min((slot.flush_watermark for slot in self.streams.values() if slot.added),
+                            default=0)
+        else:
+            heap = self._flush_watermarks_heap
+            while heap and self.streams[heap[0][2]].version != heap[0][1]:
+                heapq.heappop(heap)
+            threshold = heap[0][0] if heap else 0
+
+        self._cached_safe_threshold = threshold
+        return threshold
+
+    def _emit_safe_queued_states(self, force=False):
+        watermarks = self._state_watermarks
+        if not watermarks:
+            return
+
+        if force:
+            emittable_count = len(watermarks)
+        else:
+            emittable_count = bisect_right(watermarks, self._safe_flush_threshold())
+
+        if emittable_count == 0:
+            return
+
+        # Only the most recent safe state matters; everything queued before it is superseded.
+        emittable_state = self._state_values[emittable_count - 1]
+        del self._state_values[:emittable_count]
+        del watermarks[:emittable_count]
+
+        if emittable_state:
+            self._emit_queue.put(emittable_state)
+
+    def _run_emit_worker(self):
+        while True:
+            emittable_state = self._emit_queue.get()
+            try:
+                if emittable_state is _SHUTDOWN:
+                    return
+                self._process_emittable_state(emittable_state)
+            except Exception as error:  # surfaced to the main thread at the next flush boundary
+                self._emit_worker_error = error
+            finally:
+                self._emit_queue.task_done()
+
+    def _process_emittable_state(self, emittable_state):
+        # Taps routinely re-emit an unchanged state blob; a cheap identity/equality check avoids the
+        # recursive structural diff in the common no-op case.
+        if emittable_state is self.last_emitted_state or emittable_state == self.last_emitted_state:
+            self.last_emitted_state = emittable_state
+            return
+
+        if len(statediff.diff(emittable_state, self.last_emitted_state)) > 0:
+            line = _dumps(emittable_state)
+            # Serialized-form dedup: states that diff as changed but encode to the same bytes need no re-emit
+            if line != self._last_emitted_state_line:
+                self._stdout_write(line)
+                self._stdout_write(b'\n')
+                self._stdout_flush()
+                self._last_emitted_state_line = line
+
+        self.last_emitted_state = emittable_state
\ No newline at end of file
@@ -10,7 +10,7 @@ from singer import utils, metadata, metrics
 
 from target_postgres import json_schema
 from target_postgres.singer_stream import BufferedSingerStream
-from target_postgres.state_tracker import StreamTracker, TargetError
+from target_postgres.stream_tracker import StreamTracker, TargetError
 
 LOGGER = singer.get_logger()
 
@@ -72,11 +72,12 @@ def stream_to_target(stream, target, config={}):
         LOGGER.critical(e)
         raise e
     finally:
+        state_tracker.close()
         _report_invalid_records(state_tracker.streams)
 
 
 def _report_invalid_records(streams):
-    for stream_buffer in streams.values():
+    for stream_buffer in (slot.buffer for slot in streams.values()):
         if stream_buffer.peek_invalid_records():
             LOGGER.warning("Invalid records detected for stream {}: {}".format(
                 stream_buffer.stream,
@@ -94,7 +95,17 @@ def _line_handler(state_tracker, target, invalid_records_detect, invalid_records
     if 'type' not in line_data:
         raise TargetError('`type` is a required key: {}'.format(line))
 
-    if line_data['type'] == 'SCHEMA':
+    # Extracted once at the parse boundary; RECORD and STATE are the hot message types so they're checked first
+    message_type = line_data['type']
+
+    if message_type == 'RECORD':
+        if 'stream' not in line_data:
+            raise TargetError('`stream` is a required key: {}'.format(line))
+
+        state_tracker.handle_record_message(line_data['stream'], line_data)
+    elif message_type == 'STATE':
+        state_tracker.handle_state_message(line_data['value'])
+    elif message_type == 'SCHEMA':
         if 'stream' not in line_data:
             raise TargetError('`stream` is a required key: {}'.format(line))
 
@@ -127,13 +138,8 @@ def _line_handler(state_tracker, target, invalid_records_detect, invalid_records
 
             state_tracker.register_stream(stream, buffered_stream)
         else:
-            state_tracker.streams[stream].update_schema(schema, key_properties)
-    elif line_data['type'] == 'RECORD':
-        if 'stream' not in line_data:
-            raise TargetError('`stream` is a required key: {}'.format(line))
-
-        state_tracker.handle_record_message(line_data['stream'], line_data)
-    elif line_data['type'] == 'ACTIVATE_VERSION':
+            state_tracker.streams[stream].buffer.update_schema(schema, key_properties)
+    elif message_type == 'ACTIVATE_VERSION':
         if 'stream' not in line_data:
             raise TargetError('`stream` is a required key: {}'.format(line))
         if 'version' not in line_data:
@@ -142,14 +148,12 @@ def _line_handler(state_tracker, target, invalid_records_detect, invalid_records
             raise TargetError('A ACTIVATE_VERSION for stream {} was encountered before a corresponding schema'
                               .format(line_data['stream']))
 
-        stream_buffer = state_tracker.streams[line_data['stream']]
+        stream_buffer = state_tracker.streams[line_data['stream']].buffer
         target.write_batch(stream_buffer)
         target.activate_version(stream_buffer, line_data['version'])
-    elif line_data['type'] == 'STATE':
-        state_tracker.handle_state_message(line_data['value'])
     else:
         raise TargetError('Unknown message type {} in message {}'.format(
-            line_data['type'],
+            message_type,
             line))
 
 